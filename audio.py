@@ -1,14 +1,24 @@
-import random
 import os
 import sys
 import json
+import re
 from pathlib import Path
 import logging
+import contextlib
 import textgrid
 import torch
 import torchaudio
-import math
 import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+try:
+    import orjson
+except ImportError:
+    orjson = None
+try:
+    # only used to scan audio folders (find_audio_files), training doesn't need it
+    import soundfile as sf
+except ImportError:
+    sf = None
 torchaudio.set_audio_backend("sox_io")
 from learner import logger
 
@@ -25,18 +35,47 @@ phoneme_to_index_dict = { "" : 1, "AA0": 2, 'AA1': 3, 'AA2': 4, 'AE0': 5 ,'AE1':
      'UH2':62, 'UW0':63, 'UW1':64, 'UW2':65, 'V':66, 'W':67, 'Y':68, 'Z':69, 'ZH':70, 'spn':71, 'sil':72
 }
 
+## below this number of files the scan runs serially, a thread pool isn't worth its overhead
+MIN_FILES_FOR_PARALLEL_SCAN = 25
+
+def _walk_files(path, exts):
+    files_found = []
+    for root, folders, files in os.walk(path, followlinks=True):
+        for file in files:
+            file = Path(root) / file
+            if file.suffix.lower() in exts:
+                files_found.append(str(file.resolve()))
+    return files_found
+
+def walk_files(path, exts):
+    """
+    returns the resolved paths of all files with a suffix in `exts` under `path`,
+    the top level subdirectories are walked in parallel
+    """
+    entries = list(os.scandir(path))
+    files_found = [str(Path(entry.path).resolve()) for entry in entries
+                   if entry.is_file() and Path(entry.name).suffix.lower() in exts]
+    subdirs = [entry.path for entry in entries if entry.is_dir()]
+    with ThreadPoolExecutor(max_workers=min(len(subdirs), os.cpu_count() * 2) or 1) as ex:
+        for sub_files in ex.map(lambda subdir: _walk_files(subdir, exts), subdirs):
+            files_found += sub_files
+    return files_found
+
+def load_manifest(json_manifest):
+    """
+    loads a json manifest, with orjson when it's installed (much faster on large manifests)
+    """
+    if orjson is not None:
+        return orjson.loads(Path(json_manifest).read_bytes())
+    return json.load(open(json_manifest, "r"))
+
 ##TODO##
 def find_TextGrid_files(path, exts=[".textgrid"], progress=True):
     """
     dump all files in the given path to a json file with the format:
     [(file_path),...]
     """
-    audio_files = []
-    for root, folders, files in os.walk(path, followlinks=True):
-        for file in files:
-            file = Path(root) / file
-            if file.suffix.lower() in exts:
-                audio_files.append(str(file.resolve()))    
+    audio_files = walk_files(path, exts)
     meta = []
     for idx, file in enumerate(audio_files):
         meta.append((file))
@@ -45,47 +84,66 @@ def find_TextGrid_files(path, exts=[".textgrid"], progress=True):
     meta.sort()
     return meta
 
+def get_num_frames(file):
+    """
+    returns the number of frames (samples per channel) of an audio file, reading only its header
+    """
+    if sf is not None:
+        try:
+            return sf.info(file).frames
+        except RuntimeError:
+            # formats libsndfile can't read
+            pass
+    return torchaudio.info(file).num_frames
+
 ##TODO##
-def find_audio_files(path, exts=[".wav"], progress=True):
+def find_audio_files(path, exts=[".wav"], progress=True, cache_file=None):
     """
     dump all files in the given path to a json file with the format:
     [(audio_path, audio_length),...]
+    cache_file - optional json file of {audio_path: [mtime, audio_length]} from previous scans,
+    files whose mtime didn't change are not opened again
     """
-    audio_files = []
-    for root, folders, files in os.walk(path, followlinks=True):
-        for file in files:
-            file = Path(root) / file
-            if file.suffix.lower() in exts:
-                audio_files.append(str(file.resolve()))
-    meta = []
-    for idx, file in enumerate(audio_files):
-        siginfo = torchaudio.info(file)
-        length = siginfo.num_frames // siginfo.num_channels
-        meta.append((file, length))
-        if progress:
-            print(format((1 + idx) / len(audio_files), " 3.1%"), end='\r', file=sys.stderr)
+    audio_files = walk_files(path, exts)
+    cache = {}
+    if cache_file is not None and os.path.exists(cache_file):
+        cache = json.load(open(cache_file, "r"))
+    mtimes = [os.path.getmtime(file) for file in audio_files]
+    to_scan = [file for file, mtime in zip(audio_files, mtimes)
+               if file not in cache or cache[file][0] != mtime]
+    # reading the headers is I/O bound, so threads are enough
+    pool = ThreadPoolExecutor(max_workers=os.cpu_count() * 2) if len(to_scan) >= MIN_FILES_FOR_PARALLEL_SCAN else None
+    with pool or contextlib.nullcontext():
+        lengths = pool.map(get_num_frames, to_scan) if pool else map(get_num_frames, to_scan)
+        for idx, (file, length) in enumerate(zip(to_scan, lengths)):
+            cache[file] = [os.path.getmtime(file), length]
+            if progress:
+                print(format((1 + idx) / len(to_scan), " 3.1%"), end='\r', file=sys.stderr)
+    meta = [(file, cache[file][1]) for file in audio_files]
+    if cache_file is not None:
+        json.dump(cache, open(cache_file, "w"))
     meta.sort()
     return meta
 
-def get_overlap_duration(start_p, info_taken_phonemes, window_length):
+def get_overlap_duration(start_p, taken_phonemes_end, window_length):
     ### In case of conditional synthesis, we would like to choose which phonemes 
     ### from the last window will apeear in the current window.
     ### we assume that aprox 1/3 phonemes from the last window is involving in the current window
     ### and also assume that this part will be 1/3 phonemes from the current frame.
-    ### the function gets the info about the phonemes on a specific window
+    ### the function gets the end samples of the phonemes on a specific window
     ### the function return the overlap (which part of the window is visible)
 
-    total_phonemes = len(info_taken_phonemes)
+    total_phonemes = len(taken_phonemes_end)
 
     assert total_phonemes>=1, "There must be at list one phoneme in a current window"
     desirable_phonemes = np.abs((-total_phonemes)//3)
     assert desirable_phonemes>=1, "There must be at list one phoneme in the overlap area"
 
-    overlap_duration = info_taken_phonemes[desirable_phonemes-1].maxTime*16000 - start_p
-    i=2
-    while overlap_duration > window_length/2 and desirable_phonemes-i>=0:
-        overlap_duration = info_taken_phonemes[desirable_phonemes-i].maxTime*16000 - start_p
-        i+=1
+    overlap_ends = np.asarray(taken_phonemes_end[:desirable_phonemes]) - start_p
+    ## the ends are sorted, so the last one of the desirable phonemes that ends in the first half of the window
+    ## (or the first phoneme, if none does) is found with a single search
+    last_fitting = max(np.searchsorted(overlap_ends, window_length/2, side='right') - 1, 0)
+    overlap_duration = overlap_ends[last_fitting]
 
     overlap_duration =  min(int(round(overlap_duration)),  int(round(window_length/2)))
     return overlap_duration
@@ -98,104 +156,152 @@ def sample_segment(audio, n_samples, ret_idx=False):
     n_samples - int, this will be the new length of audio
     ret_idx - if True then the start and end indices will be returned
     """
+    start, end = sample_segment_idx(audio.shape[1], n_samples)
     if audio.shape[1] > n_samples:
-        diff = audio.shape[1] - n_samples
-        start = random.randint(0, diff)
-        end = start + n_samples
-        new_audio = audio[:, start:end]
-        if ret_idx:
-            return new_audio, (start, end)
-        return new_audio
-
+        audio = audio[:, start:end]
     if ret_idx:
-        return audio, (0, audio.shape[1] - 1)
+        return audio, (start, end)
     return audio
 
-def build_phoneme_and_energy_representation(total_phoneme_len, phoneme_numer, cur_energy):
+def sample_segment_idx(length, n_samples):
+    """
+    samples the start and end indices of a random segment of `n_samples` from an audio of `length` samples,
+    the same way `sample_segment` does, so the segment can be decoded without loading the whole file.
+    """
+    if length > n_samples:
+        diff = length - n_samples
+        # torch RNG is seeded per DataLoader worker, so workers draw different segments
+        start = int(torch.randint(0, diff + 1, (1,)))
+        return start, start + n_samples
+    return 0, length - 1
+
+def phoneme_tier_to_arrays(phonemes, sr=16000):
+    """
+    converts a TextGrid phoneme tier to numpy arrays, one entry per phoneme:
+    (start sample, end sample, phoneme index)
+    """
+    mins_samp = np.rint(np.array([phoneme.minTime for phoneme in phonemes], dtype=np.float64) * sr).astype(np.int64)
+    maxs_samp = np.rint(np.array([phoneme.maxTime for phoneme in phonemes], dtype=np.float64) * sr).astype(np.int64)
+    _lookup = phoneme_to_index_dict.__getitem__
+    marks_idx = np.fromiter((_lookup(phoneme.mark) for phoneme in phonemes), dtype=np.int64, count=len(phonemes))
+    return mins_samp, maxs_samp, marks_idx
+
+## intervals of a long format (praat "ooTextFile") TextGrid tier
+TEXTGRID_INTERVAL_RE = re.compile(r'xmin = ([-+\d.eE]+)\s+xmax = ([-+\d.eE]+)\s+text = "([^"]*)"')
+TEXTGRID_ITEM_RE = re.compile(r'^\s*item \[\d+\]:\s*$', flags=re.M)
+## the textgrid package rounds every time it parses to this many digits (textgrid.DEFAULT_TEXTGRID_PRECISION)
+TEXTGRID_PRECISION = 5
+
+def parse_phoneme_tier_fast(path, sr=16000, tier=1):
+    """
+    parses the phoneme tier of a TextGrid straight into the arrays of `phoneme_tier_to_arrays`,
+    without building the textgrid objects.
+    tier - index of the phoneme tier, as in `textgrid.TextGrid.fromFile(path)[tier]`
+    returns None if the file isn't a long format TextGrid, the caller should use the textgrid package then
+    """
+    with open(path, "r") as f:
+        sections = TEXTGRID_ITEM_RE.split(f.read())
+    if len(sections) <= tier + 1:
+        return None
+    intervals = TEXTGRID_INTERVAL_RE.findall(sections[tier + 1])
+    if not intervals:
+        return None
+    # rounded like the textgrid package does (python's round, not np.round, which can differ in the last digit)
+    # and, like it, skipping empty intervals, so both parse paths give the same samples and phoneme order
+    intervals = [(round(float(xmin), TEXTGRID_PRECISION), round(float(xmax), TEXTGRID_PRECISION), mark)
+                 for xmin, xmax, mark in intervals]
+    intervals = [interval for interval in intervals if interval[0] < interval[1]]
+    if not intervals:
+        return None
+    mins, maxs, marks = zip(*intervals)
+    _lookup = phoneme_to_index_dict.__getitem__
+    mins_samp = np.rint(np.array(mins, dtype=np.float64) * sr).astype(np.int64)
+    maxs_samp = np.rint(np.array(maxs, dtype=np.float64) * sr).astype(np.int64)
+    marks_idx = np.fromiter((_lookup(mark) for mark in marks), dtype=np.int64, count=len(marks))
+    return mins_samp, maxs_samp, marks_idx
+
+def Build_excisting_phonemes_sec_approach(start_frame, end_frame ,phonemes_a, Energy_a):
+    """
+    builds the phoneme and energy conditioning signals of the window [start_frame, end_frame)
+    phonemes_a - the phoneme tier as returned by `phoneme_tier_to_arrays`
+    Energy_a - energy per phoneme
+    returns the phonemes signal [1, T], the end samples of the phonemes in the window, and the energy signal [1, T]
+    """
+    mins_samp, maxs_samp, marks_idx = phonemes_a
+    n_phonemes = min(len(marks_idx), len(Energy_a))
+    ## phonemes are sorted in time, so the ones overlapping the window are a contiguous range
+    lo = np.searchsorted(maxs_samp[:n_phonemes], start_frame, side='right')
+    hi = np.searchsorted(mins_samp[:n_phonemes], end_frame, side='left')
+    lengths = np.minimum(maxs_samp[lo:hi], end_frame) - np.maximum(mins_samp[lo:hi], start_frame)
 
     ## represent by repeating the phoneme_number devided by the total num of the phonemes. 
-    represent_sign = phoneme_numer / TOTAL_AVAILABLE_PHONEMES
-    phonemes_representaion = torch.Tensor.repeat(torch.tensor(represent_sign),math.floor(total_phoneme_len))
-    energy_representaion = torch.Tensor.repeat(torch.tensor(cur_energy),math.floor(total_phoneme_len))
-    return phonemes_representaion, energy_representaion
-
-def Build_excisting_phonemes_sec_approach(start_frame, end_frame ,phonemes_a, Energy_a, sr):
-    list_taken_phonemes = []
-    list_info_taken_phonemes = []
-    conditioned_phonemes_signal = torch.empty((0)) 
-    conditioned_energy_signal = torch.empty((0)) 
-    for phoneme, cur_energy in zip(phonemes_a,Energy_a) :
-        start_phoneme = round(phoneme.minTime * sr)
-        end_phoneme = round(phoneme.maxTime * sr)
-        phoneme_mark = phoneme.mark
-        if start_phoneme >= end_frame : # --> start_frame < start_phoneme
-            break
-        elif end_phoneme <= start_frame : # --> end_frame>end_phoneme
-            continue
-        elif start_phoneme >= start_frame:
-            if end_phoneme<= end_frame:
-                total_phoneme_length = round(end_phoneme-start_phoneme)
-                list_taken_phonemes.append([phoneme_to_index_dict[phoneme_mark],total_phoneme_length])
-                list_info_taken_phonemes.append(phoneme)
-                cur_phoneme_representaion, cur_energy_representation = build_phoneme_and_energy_representation(total_phoneme_length,
-                                                phoneme_to_index_dict[phoneme_mark], cur_energy)
-                conditioned_phonemes_signal = torch.concat((conditioned_phonemes_signal,cur_phoneme_representaion))
-                conditioned_energy_signal = torch.concat((conditioned_energy_signal,cur_energy_representation))
-                continue
-            else: # --> end_phoneme > end_frame
-                total_phoneme_length = round(end_frame-start_phoneme)
-                list_taken_phonemes.append([phoneme_to_index_dict[phoneme_mark],total_phoneme_length])
-                list_info_taken_phonemes.append(phoneme)
-                cur_phoneme_representaion, cur_energy_representation = build_phoneme_and_energy_representation(total_phoneme_length,
-                                                phoneme_to_index_dict[phoneme_mark], cur_energy)
-                conditioned_phonemes_signal = torch.concat((conditioned_phonemes_signal,cur_phoneme_representaion))
-                conditioned_energy_signal = torch.concat((conditioned_energy_signal,cur_energy_representation))
-                continue
-        elif start_phoneme <= start_frame:
-            if end_phoneme >= end_frame:
-                total_phoneme_length = round(end_frame-start_frame)
-                list_taken_phonemes.append([phoneme_to_index_dict[phoneme_mark],total_phoneme_length])
-                list_info_taken_phonemes.append(phoneme)
-                cur_phoneme_representaion, cur_energy_representation = build_phoneme_and_energy_representation(total_phoneme_length,
-                                                phoneme_to_index_dict[phoneme_mark], cur_energy)
-                conditioned_phonemes_signal = torch.concat((conditioned_phonemes_signal,cur_phoneme_representaion))
-                conditioned_energy_signal = torch.concat((conditioned_energy_signal,cur_energy_representation))
-                continue
-            else: # --> ende_frame > end_phonem
-                total_phoneme_length = round(end_phoneme-start_frame)
-                list_taken_phonemes.append([phoneme_to_index_dict[phoneme_mark],total_phoneme_length])
-                list_info_taken_phonemes.append(phoneme)
-                cur_phoneme_representaion, cur_energy_representation = build_phoneme_and_energy_representation(total_phoneme_length,
-                                                phoneme_to_index_dict[phoneme_mark], cur_energy)
-                conditioned_phonemes_signal = torch.concat((conditioned_phonemes_signal,cur_phoneme_representaion))
-                conditioned_energy_signal = torch.concat((conditioned_energy_signal,cur_energy_representation))
-                continue
-        else:
-            assert  False, "Roi you missed at least one case."
+    conditioned_phonemes_signal = torch.from_numpy(np.repeat(marks_idx[lo:hi] / TOTAL_AVAILABLE_PHONEMES, lengths).astype(np.float32))
+    conditioned_energy_signal = torch.from_numpy(np.repeat(np.asarray(Energy_a[lo:hi], dtype=np.float32), lengths))
 
-    tensor_taken_phonemes = torch.tensor(list_taken_phonemes)
     ## The int, round, came after the run training
     assert conditioned_phonemes_signal.shape[0] == int(round(end_frame-start_frame)), f"some how {conditioned_phonemes_signal.shape[0]} and {end_frame-start_frame} are different"
-    assert conditioned_phonemes_signal.shape[0] == conditioned_energy_signal.shape[0], f"some how {conditioned_phonemes_signal.shape[0]} and {conditioned_energy_signal.shape[0]} are different"
-    assert tensor_taken_phonemes.shape[0]>0 , "There are no phonemes in the phonemes tensor."
-    return conditioned_phonemes_signal[None,:], list_info_taken_phonemes, conditioned_energy_signal[None,:]
+    assert hi > lo , "There are no phonemes in the phonemes tensor."
+    return conditioned_phonemes_signal[None,:], maxs_samp[lo:hi], conditioned_energy_signal[None,:]
+
+def load_phoneme_tier(path):
+    phonemes = parse_phoneme_tier_fast(path)
+    if phonemes is None:
+        tg = textgrid.TextGrid.fromFile(path)
+        phonemes = phoneme_tier_to_arrays(tg[1])
+    return phonemes
+
+def preprocess_textgrids(json_manifest_TextGrids, out_path):
+    """
+    parses all the TextGrids of a manifest once and saves their phoneme tiers to a single .npz:
+    the intervals of all files concatenated (`mins`, `maxs`, `marks_idx`), the (start, count)
+    of every file in them (`offsets`) and the file paths (`files`), to check the manifest against.
+    """
+    files = load_manifest(json_manifest_TextGrids)
+    tiers = [load_phoneme_tier(path) for path in files]
+    counts = np.array([len(marks_idx) for _, _, marks_idx in tiers], dtype=np.int64)
+    offsets = np.stack([np.cumsum(counts) - counts, counts], axis=1)
+    np.savez(out_path,
+             mins=np.concatenate([mins for mins, _, _ in tiers]),
+             maxs=np.concatenate([maxs for _, maxs, _ in tiers]),
+             marks_idx=np.concatenate([marks_idx for _, _, marks_idx in tiers]),
+             offsets=offsets,
+             files=np.array(files))
 
 class TextGridDataset(torch.utils.data.Dataset):
-    def __init__(self, json_manifest_TextGrids):
-        self.files = json.load(open(json_manifest_TextGrids, "r"))
+    def __init__(self, json_manifest_TextGrids, preprocessed=None):
+        """
+        preprocessed - optional .npz written by `preprocess_textgrids` for this manifest,
+        when given no TextGrid is parsed during training
+        """
+        self.files = load_manifest(json_manifest_TextGrids)
+        ## parsed phoneme tiers, kept per DataLoader worker so each TextGrid is parsed only once
+        self._cache = {}
+        self._preprocessed = None
+        if preprocessed is not None:
+            # .npz members can't be memory mapped, but all the intervals of a corpus are only a few MB
+            with np.load(preprocessed) as data:
+                if data["files"].tolist() == self.files:
+                    self._preprocessed = {key: data[key] for key in ("mins", "maxs", "marks_idx", "offsets")}
+                else:
+                    logger.warning(f"{preprocessed} doesn't match {json_manifest_TextGrids}, parsing the TextGrids instead")
     
     def __len__(self):
         return len(self.files)
     
     def __getitem__(self,i):   
-        path = self.files[i]
-        tg = textgrid.TextGrid.fromFile(path)
+        if self._preprocessed is not None:
+            start, count = self._preprocessed["offsets"][i]
+            return tuple(self._preprocessed[key][start:start + count] for key in ("mins", "maxs", "marks_idx"))
+
+        phonemes = self._cache.get(i)
+        if phonemes is None:
+            phonemes = self._cache[i] = load_phoneme_tier(self.files[i])
 
-        return tg
+        return phonemes
 
 class Npy_EnergyDataset(torch.utils.data.Dataset):
     def __init__(self, json_manifest_npy_energy):
-        self.files = json.load(open(json_manifest_npy_energy, "r"))
+        self.files = load_manifest(json_manifest_npy_energy)
     
     def __len__(self):
         return len(self.files)
@@ -206,34 +312,113 @@ class Npy_EnergyDataset(torch.utils.data.Dataset):
 
         return cur_energy
     
+## formats libsndfile/sox decode from `frame_offset` without decoding what comes before it,
+## only the others (e.g mp3, m4a) go through the ffmpeg StreamReader
+SEEKABLE_AUDIO_EXTS = (".wav", ".flac", ".ogg", ".aiff", ".aif", ".au", ".w64")
+
+def load_segment_stream(path, start, n_samples):
+    """
+    decodes `n_samples` samples starting at `start` with the ffmpeg StreamReader,
+    which seeks in compressed formats instead of decoding the file from its beginning.
+    `start` and `n_samples` are in frames of the file's own sample rate (as in the manifest) and, like
+    `torchaudio.load`, the audio is returned at that rate.
+    returns a tensor of shape [channels, n_samples], zero padded if the file ends early
+    (lengths read from mp3 headers are approximate)
+    """
+    reader = torchaudio.io.StreamReader(path)
+    src_sample_rate = reader.get_src_stream_info(reader.default_audio_stream).sample_rate
+    reader.add_basic_audio_stream(frames_per_chunk=n_samples)
+    reader.seek(start / src_sample_rate, mode="precise")
+    reader.fill_buffer()
+    (audio,) = reader.pop_chunks()
+    if audio is None:
+        raise RuntimeError(f"no audio decoded from {path} at frame {start}, the manifest length may be wrong")
+    audio = audio.T
+    if audio.shape[1] < n_samples:
+        audio = torch.nn.functional.pad(audio, (0, n_samples - audio.shape[1]))
+    return audio
+
+## default bound on the decoded waveforms kept by `AudioDataset(cache_in_memory=True)`, per training process (one per GPU):
+## the cache is filled before the DataLoader workers fork, so they share it copy-on-write
+AUDIO_CACHE_MAX_BYTES = 8 * 2**30
+
 class AudioDataset(torch.utils.data.Dataset):
-    def __init__(self, json_manifest, n_samples=None, min_duration=0, max_duration=float("inf")):
+    def __init__(self, json_manifest, n_samples=None, min_duration=0, max_duration=float("inf"),
+                 cache_in_memory=False, cache_max_bytes=AUDIO_CACHE_MAX_BYTES):
         if n_samples:
             assert n_samples <= min_duration, "`min_duration` must be greater than `n_samples`"
         self.n_samples = n_samples
+        self.cache_in_memory = cache_in_memory
+        self.cache_max_bytes = cache_max_bytes
+        self._cache = {}
 
         # load list of files
         logger.info(f"loading from: {json_manifest}")
-        self.files = json.load(open(json_manifest, "r"))
+        self.files = load_manifest(json_manifest)
         logger.info(f"files in manifest: {len(self.files)}")
         # filter files that are with Inappropriate duration
-        self.files = list(filter(lambda x: min_duration <= x[1] <= max_duration, self.files))
+        lengths = np.fromiter((length for _, length in self.files), dtype=np.float64, count=len(self.files))
+        keep = np.flatnonzero((lengths >= min_duration) & (lengths <= max_duration))
+        self.files = [self.files[idx] for idx in keep]
         logger.info(f"files after duration filtering: {len(self.files)}")
 
+        if cache_in_memory:
+            self._fill_cache()
+
+    def _fill_cache(self):
+        """
+        decodes the files into memory, until `cache_max_bytes` is reached, the rest are decoded per item.
+        runs in the main process, so the DataLoader workers share the cache instead of each building its own copy.
+        """
+        cache_bytes = 0
+        for i, (path, length) in enumerate(self.files):
+            audio, sr = torchaudio.load(path)
+            audio_bytes = audio.numel() * audio.element_size()
+            if cache_bytes + audio_bytes > self.cache_max_bytes:
+                break
+            self._cache[i] = audio
+            cache_bytes += audio_bytes
+        logger.info(f"cached {len(self._cache)}/{len(self.files)} files in memory ({cache_bytes / 2**30:.2f} GiB)")
+
     def __len__(self):
         return len(self.files)
 
     def __getitem__(self, i):
         path, length = self.files[i]
-        audio, sr = torchaudio.load(path)
-
         if self.n_samples:
-            audio = sample_segment(audio, self.n_samples)
+            start, end = sample_segment_idx(length, self.n_samples)
+            return self.load_segment(i, start, self.n_samples)
+
+        if i in self._cache:
+            return self._cache[i].clone()
+        audio, sr = torchaudio.load(path)
+        return audio
 
+    def load_segment(self, i, start, n_samples):
+        """
+        decodes only `n_samples` samples of the i'th file, starting at `start`.
+        files of at most `n_samples` samples are returned whole, as in `sample_segment`.
+        """
+        path, length = self.files[i]
+        if i in self._cache:
+            # callers modify the returned segment in place, so it must not be a view of the cache
+            audio = self._cache[i]
+            if length > n_samples:
+                audio = audio[:, start:start + n_samples]
+            return audio.clone()
+        if length > n_samples and Path(path).suffix.lower() not in SEEKABLE_AUDIO_EXTS:
+            return load_segment_stream(path, start, n_samples)
+        num_frames = n_samples if length > n_samples else -1
+        audio, sr = torchaudio.load(path, frame_offset=start, num_frames=num_frames)
         return audio
 
 class PairedAudioDataset(torch.utils.data.Dataset):
-    def __init__(self, json_wav, json_TextGrids, json_npy_Energy,  n_samples=None, min_duration=0, max_duration=float("inf")):
+    """
+    decoding is done per item in `__getitem__`, so the DataLoader should use
+    num_workers>=4, pin_memory=True and persistent_workers=True to keep it off the training process.
+    """
+    def __init__(self, json_wav, json_TextGrids, json_npy_Energy,  n_samples=None, min_duration=0, max_duration=float("inf"),
+                 cache_in_memory=False, preprocessed_TextGrids=None):
 
         if n_samples:
             assert n_samples <= min_duration, "`min_duration` must be greater than `n_samples`"
@@ -244,17 +429,14 @@ class PairedAudioDataset(torch.utils.data.Dataset):
             n_samples=None, 
             min_duration=min_duration,
             max_duration=max_duration,
+            cache_in_memory=cache_in_memory,
         )
-       
-        self.ds_b = AudioDataset(
-            json_manifest=json_wav,
-            n_samples=None, 
-            min_duration=min_duration,
-            max_duration=max_duration,
-        )
+        # both waveforms come from the same manifest, audio_b is a masked copy of audio_a
+        self.ds_b = self.ds_a
 
         self.ds_textgrids_a = TextGridDataset(
             json_manifest_TextGrids=json_TextGrids,
+            preprocessed=preprocessed_TextGrids,
         )
 
         self.ds_energy_a = Npy_EnergyDataset(
@@ -268,23 +450,29 @@ class PairedAudioDataset(torch.utils.data.Dataset):
 
     def __getitem__(self, i):
         # Using the same index for iterators.
-        audio_a = self.ds_a[i]
-        audio_b = self.ds_b[i]
-        phonemes_a =  self.ds_textgrids_a[i][1]
+        phonemes_a =  self.ds_textgrids_a[i]
         Energy_a = self.ds_energy_a[i]
         if self.n_samples:
             # sample identically for both waveforms (calling to PairedAudioDataset)
-            # (using n_samples != None)
-            audio_a, (start, end) = sample_segment(audio_a, self.n_samples, ret_idx=True)
+            # (using n_samples != None), only the sampled segment is decoded
+            path, length = self.ds_a.files[i]
+            start, end = sample_segment_idx(length, self.n_samples)
+            audio_a = self.ds_a.load_segment(i, start, self.n_samples)
+        else:
+            audio_a = self.ds_a[i]
 
-        conditioned_phonemes_signal_a, list_info_cur_taken_phonemes, conditioned_energy_signal_a = \
-            Build_excisting_phonemes_sec_approach(start, end ,phonemes_a,Energy_a,16000)
+        conditioned_phonemes_signal_a, cur_taken_phonemes_end, conditioned_energy_signal_a = \
+            Build_excisting_phonemes_sec_approach(start, end ,phonemes_a,Energy_a)
 
         if self.n_samples:
         ###The overlap is by num of samples and not by time.
-            overlap_zone = int(get_overlap_duration(start, list_info_cur_taken_phonemes, 8000))
-            audio_b = audio_b[:, start:end]
-            audio_b[:,overlap_zone:]=0
+            overlap_zone = int(get_overlap_duration(start, cur_taken_phonemes_end, 8000))
+            # only the visible part is copied, the rest is zeroed in place
+            audio_b = torch.empty_like(audio_a)
+            audio_b[:,:overlap_zone].copy_(audio_a[:,:overlap_zone])
+            audio_b[:,overlap_zone:].zero_()
+        else:
+            audio_b = audio_a.clone()
 
         return audio_a, audio_b, conditioned_phonemes_signal_a, conditioned_energy_signal_a, overlap_zone
     
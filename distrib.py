@@ -38,13 +38,11 @@ def average(metrics, count=1.):
     `metrics`should be a 1D float32 vector. Returns the average of `metrics`
     over all hosts. You can use `count` to control the weight of each worker.
     """
-    if world_size == 1:
+    if world_size == 1 or not torch.distributed.is_initialized():
         return metrics
     tensor = torch.tensor(list(metrics) + [1], device='cuda', dtype=torch.float32)
-    # tensor = torch.tensor(list(metrics) + [1], dtype=torch.float32)
     tensor *= count
-    # torch.distributed.all_reduce(tensor, op=torch.distributed.ReduceOp.SUM)
-    # TODO
+    torch.distributed.all_reduce(tensor, op=torch.distributed.ReduceOp.SUM)
     return (tensor[:-1] / tensor[-1]).cpu().numpy().tolist()
 
 
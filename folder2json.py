@@ -1,9 +1,15 @@
+import argparse
 import json
 import sys
 from audio import find_audio_files
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("paths", nargs="+")
+    parser.add_argument("--cache", default=None,
+                        help="json of the lengths found by previous runs, unchanged files are not opened again")
+    args = parser.parse_args()
     meta = []
-    for path in sys.argv[1:]:
-        meta += find_audio_files(path)
+    for path in args.paths:
+        meta += find_audio_files(path, cache_file=args.cache)
     json.dump(meta, sys.stdout, indent=4)
@@ -9,7 +9,7 @@ import random
 from pathlib import Path
 import textgrid
 from model import DiffAR
-from utils_for_inference import Build_excisting_phonemes_sec_approach, get_overlap_duration
+from utils_for_inference import Build_excisting_phonemes_sec_approach, get_overlap_duration, phoneme_tier_bounds
 import time
 from params import AttrDict, params as base_params
 from duration_predictors_files.Text_To_Speech_Procedure import producing_filename_text_phoneme_list, test_on_given_lists
@@ -215,6 +215,7 @@ def predict_cond_model_sec_approach_list_full_wav(Textgrid_path, Energy_npy_path
 
     audio_a, sr = torchaudio.load(f"/home/mlspeech/rbenita/PycharmProjects/git_models/DiffAR_200/empty_sec_audio.wav")
     phoneme = textgrid.TextGrid.fromFile(Textgrid_path)[1]
+    phoneme_bounds = phoneme_tier_bounds(phoneme, base_params.sample_rate)
     Energy = np.load(Energy_npy_path)
     if not(len(Energy)==len(phoneme)):
         print("Energy padding first None Phoneme")
@@ -234,7 +235,7 @@ def predict_cond_model_sec_approach_list_full_wav(Textgrid_path, Energy_npy_path
             total_length_curr_window = int(round(end_cur_phonemes-start_cur_phonemes))
             conditioned_audio = torch.zeros((1,total_length_curr_window))
             conditioned_phonemes_signal, list_info_cur_taken_phonemes, conditioned_energy_signal = \
-            Build_excisting_phonemes_sec_approach(start_cur_phonemes, end_cur_phonemes ,phoneme,Energy, base_params.sample_rate)
+            Build_excisting_phonemes_sec_approach(start_cur_phonemes, end_cur_phonemes ,phoneme,Energy, base_params.sample_rate, phoneme_bounds)
 
             print(f"Current phonemes: {list_info_cur_taken_phonemes}")
             overlap_zone = int(get_overlap_duration(start_cur_phonemes, list_info_cur_taken_phonemes, total_length_curr_window))
@@ -246,7 +247,7 @@ def predict_cond_model_sec_approach_list_full_wav(Textgrid_path, Energy_npy_path
             total_length_curr_window = int(round(end_cur_phonemes-start_cur_phonemes))
             conditioned_audio = torch.zeros((1,total_length_curr_window))
             conditioned_phonemes_signal, list_info_cur_taken_phonemes, conditioned_energy_signal = \
-            Build_excisting_phonemes_sec_approach(start_cur_phonemes, end_cur_phonemes ,phoneme,Energy, base_params.sample_rate)
+            Build_excisting_phonemes_sec_approach(start_cur_phonemes, end_cur_phonemes ,phoneme,Energy, base_params.sample_rate, phoneme_bounds)
 
             overlap_zone = int(get_overlap_duration(start_cur_phonemes, list_info_cur_taken_phonemes, total_length_curr_window))
             assert not(total_length_curr_window==0), f"Total length is zero, overlap_duration:  {overlap_duration} , overlap_zone {overlap_zone},start_cur_phonemes: {start_cur_phonemes}, end_cur_phonemes {end_cur_phonemes}, end_total_audio: {end_total_audio} "
@@ -1,14 +1,19 @@
 import numpy as np
+import io
 import os
+import pathlib
 import random
 import logging
-from concurrent.futures import ProcessPoolExecutor
+import contextlib
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
 from hydra.utils import instantiate
 from torch.nn.parallel import DistributedDataParallel
+from torch.distributed.algorithms.ddp_comm_hooks import default_hooks as ddp_hooks
 from torch.utils.data.distributed import DistributedSampler
+from torch.utils.data.dataloader import default_collate
 from torch.utils.tensorboard import SummaryWriter
 from tqdm import tqdm
 from model import DiffAR
@@ -19,6 +24,78 @@ from utils_for_inference import LogMelSpectrogram
 logger = logging.getLogger(__name__)
 logging.basicConfig(level=logging.INFO) # DEBUG
 
+NAN_CHECK_EVERY_N_STEPS = 50 # checking the loss forces a host<->device sync, so don't do it every step
+
+
+def _copy_to_host(obj, buffers, key=''):
+    """
+    recursively copies all tensors in a (nested) state dict to host memory.
+    device tensors are copied (non-blocking) into pinned buffers that are allocated on first use and reused on
+    later calls, so the caller must synchronize before reading the result.
+    the copy is a snapshot, so it is safe to serialize it while training keeps updating the originals
+    """
+    if isinstance(obj, torch.Tensor):
+        if obj.device.type == 'cpu':
+            return obj.detach().clone()
+        buffer = buffers.get(key)
+        if buffer is None or buffer.shape != obj.shape or buffer.dtype != obj.dtype:
+            buffer = buffers[key] = torch.empty_like(obj, device='cpu', pin_memory=True)
+        buffer.copy_(obj.detach(), non_blocking=True)
+        return buffer
+    if isinstance(obj, dict):
+        return { k: _copy_to_host(v, buffers, f'{key}/{k}') for k, v in obj.items() }
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(_copy_to_host(v, buffers, f'{key}/{i}') for i, v in enumerate(obj))
+    return obj
+
+
+@torch.jit.script
+def make_noisy_audio(audio, noise, t, noise_level_sqrt, one_minus_noise_level_sqrt):
+    # q(x_t | x_0) sample; scripted so the elementwise ops fuse into one kernel
+    return noise_level_sqrt[t].unsqueeze(1) * audio + one_minus_noise_level_sqrt[t].unsqueeze(1) * noise
+
+
+def collate_batch(batch):
+    # drop the channel dim of the audio in the loader workers, instead of in the training loop
+    clean, conditioned_audio, conditioned_phonemes, conditioned_energy, overlap = default_collate(batch)
+    return clean.squeeze(1), conditioned_audio.squeeze(1), conditioned_phonemes, conditioned_energy, overlap
+
+
+class CUDAPrefetcher:
+    """
+    wraps a DataLoader and copies the next batch to `device` on a side stream while the current batch is being used.
+    the copies are only asynchronous if the loader uses pin_memory=True
+    """
+    def __init__(self, loader, device):
+        self.loader = loader
+        self.device = device
+        self.stream = torch.cuda.Stream(device) if device.type == 'cuda' else None
+
+    def __len__(self):
+        return len(self.loader)
+
+    def __iter__(self):
+        loader_iter = iter(self.loader)
+        next_batch = self._preload(loader_iter)
+        while next_batch is not None:
+            if self.stream is not None:
+                current_stream = torch.cuda.current_stream(self.device)
+                current_stream.wait_stream(self.stream)
+                for x in next_batch:
+                    if isinstance(x, torch.Tensor):
+                        x.record_stream(current_stream)
+            batch = next_batch
+            next_batch = self._preload(loader_iter)
+            yield batch
+
+    def _preload(self, loader_iter):
+        try:
+            batch = next(loader_iter)
+        except StopIteration:
+            return None
+        with torch.cuda.stream(self.stream) if self.stream is not None else contextlib.nullcontext():
+            return [x.to(self.device, non_blocking=True) if isinstance(x, torch.Tensor) else x for x in batch]
+
 
 class DiffARLearner:
     def __init__(self, model, train_ds, valid_ds, test_ds, is_master, params, *args, **kwargs):
@@ -31,13 +108,29 @@ class DiffARLearner:
         self.params = params
         self.step = 0
         self.is_master = is_master
+        self.is_distributed = isinstance(getattr(self.model, '_orig_mod', self.model), DistributedDataParallel)
+        self.grad_accum_steps = params.grad_accum_steps
+        #--- `step` counts optimizer steps (max_steps, logs and checkpoint names); `micro_step` counts batches within the
+        #    accumulation window. it is not checkpointed: the accumulated grads aren't either, so a resumed run starts a new window
+        self.micro_step = 0
+        self.grad_norm = 0.
         self.device = next(self.model.parameters()).device
+        #--- mixed precision: bf16 has fp32 range so only fp16 needs the grad scaler
+        self.use_amp = params.fp16 or params.bf16
+        self.amp_dtype = torch.bfloat16 if params.bf16 else torch.float16
+        self.scaler = torch.cuda.amp.GradScaler(enabled=params.fp16 and not params.bf16)
+        #--- spec_loss_coeff is fixed for the run, so pick the loss once instead of branching on every step
         if params.spec_loss_coeff > 0.:
             self.log_mel_spec = LogMelSpectrogram(n_mels = 80).to(self.device)
+            self.compute_loss = self._loss_with_spec
+        else:
+            self.compute_loss = self._loss_denoise_only
 
         beta = np.array(self.params.noise_schedule)
-        noise_level = np.cumprod(1 - beta)
-        self.noise_level = torch.tensor(noise_level.astype(np.float32))
+        self.num_steps = len(beta)
+        self.noise_level = torch.tensor(np.cumprod(1 - beta).astype(np.float32), device=self.device)
+        self.noise_level_sqrt = self.noise_level.sqrt()
+        self.one_minus_noise_level_sqrt = (1.0 - self.noise_level).sqrt()
         self.feature_extractor = instantiate(params.features)
 
         # data augmentations
@@ -47,60 +140,105 @@ class DiffARLearner:
                 augment.append(instantiate(params[augmentation]))
         self.augment = nn.Sequential(*augment)
 
+        #--- checkpoints are written to disk by a background thread, so training does not wait on disk I/O
+        self._save_executor = ThreadPoolExecutor(max_workers=1)
+        self._pending_saves = []
+        self._host_buffers = {}
+        self._host_state = None
+        #--- pesq/stoi run on CPU in a pool that stays alive across evaluations (spawned, since CUDA is already initialized)
+        if test_ds is not None:
+            self._metric_pool = ProcessPoolExecutor(max_workers=max(1, params.num_workers),
+                                                    mp_context=torch.multiprocessing.get_context('spawn'))
+        else:
+            self._metric_pool = None
+
         self.restore_from_checkpoint()
+
+        #--- diffusion noise is drawn into a persistent buffer from a dedicated generator, seeded per rank and by the
+        #    (restored) step so a resumed run does not replay the noise of the first epochs
+        rank = torch.distributed.get_rank() if self.is_distributed else 0
+        self._noise_generator = torch.Generator(device=self.device)
+        self._noise_generator.manual_seed(int(np.random.SeedSequence([params.seed, rank, self.step]).generate_state(1)[0]))
+        self._noise_buffer = None
+
         if is_master and not params.test:
             self.summary_writer = SummaryWriter(os.getcwd(), purge_step=self.step)
 
         logger.info(f"running in: {os.getcwd()}")
         logger.info(f"model size: {sum(p.numel() for p in model.parameters()):,}")
 
+    def _unwrapped_model(self):
+        # strip the torch.compile / DDP wrappers, so checkpoint keys don't depend on how the model was run
+        model = getattr(self.model, '_orig_mod', self.model)
+        if hasattr(model, 'module') and isinstance(model.module, nn.Module):
+            model = model.module
+        return model
+
     def state_dict(self):
-        if hasattr(self.model, 'module') and isinstance(self.model.module, nn.Module):
-            model_state = self.model.module.state_dict()
-        else:
-            model_state = self.model.state_dict()
-        return {
+        #--- the host copy lives in reused pinned buffers: it is taken once per step (checkpoint and min-checkpoint
+        #    share it), and only after pending saves that still read the buffers are done
+        if self._host_state is not None and self._host_state['step'] == self.step:
+            return self._host_state
+        self.wait_for_checkpoints()
+        model_state = self._unwrapped_model().state_dict()
+        self._host_state = {
                 'step': self.step,
-                'model': { k: v.cpu() if isinstance(v, torch.Tensor) else v for k, v in model_state.items() },
-                'optimizer': { k: v.cpu() if isinstance(v, torch.Tensor) else v for k, v in self.optimizer.state_dict().items() },
+                'model': _copy_to_host(model_state, self._host_buffers, 'model'),
+                'optimizer': _copy_to_host(self.optimizer.state_dict(), self._host_buffers, 'optimizer'),
+                'scaler': self.scaler.state_dict(),
                 'params': dict(self.params),
         }
+        if self.device.type == 'cuda':
+            torch.cuda.synchronize(self.device)
+        return self._host_state
 
     def load_state_dict(self, state_dict):
-        if hasattr(self.model, 'module') and isinstance(self.model.module, nn.Module):
-            self.model.module.load_state_dict(state_dict['model'])
-        else:
-            self.model.load_state_dict(state_dict['model'])
+        self._unwrapped_model().load_state_dict(state_dict['model'])
         self.optimizer.load_state_dict(state_dict['optimizer'])
+        if 'scaler' in state_dict:
+            self.scaler.load_state_dict(state_dict['scaler'])
         self.step = state_dict['step']
 
+    def _write_checkpoint(self, state, save_name, save_basename, link_name, path):
+        #--- serialize in memory and write with a single call; the rename is atomic so the symlink never points at a torn file
+        buffer = io.BytesIO()
+        torch.save(state, buffer)
+        tmp_name = f'{save_name}.tmp'
+        with open(tmp_name, 'wb') as f:
+            f.write(buffer.getbuffer())
+        os.replace(tmp_name, save_name)
+        pathlib.Path(link_name).unlink(missing_ok=True)
+        pathlib.Path(link_name).symlink_to(save_basename)
+        # maintain only last 3 checkpoints (+1 which is the symlink)
+        checkpoints = sorted(pathlib.Path(path).glob(f'{pathlib.Path(link_name).stem}-*.pt'),
+                             key=lambda p: p.stat().st_mtime, reverse=True)
+        for checkpoint in checkpoints[3:]:
+            checkpoint.unlink(missing_ok=True)
+
+    def _submit_save(self, *args):
+        # surface errors of finished saves; a single worker keeps the pending ones in order
+        for future in [f for f in self._pending_saves if f.done()]:
+            future.result()
+            self._pending_saves.remove(future)
+        self._pending_saves.append(self._save_executor.submit(self._write_checkpoint, *args))
+
+    def wait_for_checkpoints(self):
+        for future in self._pending_saves:
+            future.result()
+        self._pending_saves = []
+
     def save_to_checkpoint(self, filename='weights'):
         save_basename = f'{filename}-{self.step}.pt'
         save_name = f'{os.getcwd()}/{save_basename}'
         link_name = f'{os.getcwd()}/{filename}.pt'
-        torch.save(self.state_dict(), save_name)
-        if os.path.islink(link_name):
-            os.unlink(link_name)
-        os.symlink(save_basename, link_name)
-        # maintain only last 3 checkpoints (+1 which is the symlink)
-        path = os.getcwd()
-        path = path.replace("[", "\[").replace("]", "\]")
-        os.system(f"rm `ls -t {path}/*.pt | awk 'NR>4'`")
+        self._submit_save(self.state_dict(), save_name, save_basename, link_name, os.getcwd())
 
     def save_to_min_checkpoint(self, filename='weights', tgt_folder = 'min'):
         save_basename = f'{filename}-{self.step}.pt'
-        os.system(f"mkdir -p {os.getcwd()}/{tgt_folder}")
+        pathlib.Path(os.getcwd(), tgt_folder).mkdir(parents=True, exist_ok=True)
         save_name = f'{os.getcwd()}/{tgt_folder}/{save_basename}'
         link_name = f'{os.getcwd()}/{tgt_folder}/{filename}.pt'
-        torch.save(self.state_dict(), save_name)
-        if os.path.islink(link_name):
-            os.unlink(link_name)
-        os.symlink(save_basename, link_name)
-        # maintain only last 3 checkpoints (+1 which is the symlink)
-        path = f'{os.getcwd()}/{tgt_folder}/'
-        # path = os.getcwd()
-        path = path.replace("[", "\[").replace("]", "\]")
-        os.system(f"rm `ls -t {path}/*.pt | awk 'NR>4'`")
+        self._submit_save(self.state_dict(), save_name, save_basename, link_name, f'{os.getcwd()}/{tgt_folder}/')
 
     def restore_from_checkpoint(self, filename='weights'):
         try:
@@ -115,36 +253,35 @@ class DiffARLearner:
 
     def train_epoch(self, dataset):
         self.model.train()
-        epoch_loss = 0
-        epoch_loss_denoise = 0
-        epoch_loss_spec = 0
-        for data in tqdm(dataset, desc=f'Step: {self.step}') if self.is_master else dataset:
-            clean, conditioned_audio, conditoned_phonemes, conditioned_energy, overlap  = data[0].squeeze(1), data[1].squeeze(1), data[2], data[3], data[4]
+        #--- [loss, denoise loss, spec loss] summed on device, read back once at the end of the epoch
+        epoch_losses = torch.zeros(3, device=self.device)
+        dataset = CUDAPrefetcher(dataset, self.device)
+        for clean, conditioned_audio, conditoned_phonemes, conditioned_energy, overlap in tqdm(dataset, desc=f'Step: {self.step}') if self.is_master else dataset:
             #--- value is non-intuitive: 
             #   -1 : don't mask_loss_using_overlap
             #   0  : mask all overlap
             #   n>0: mask all minus n samples
-            if self.params.mask_loss_using_overlap >= 0:
-                overlap = overlap.to(self.device)
-            else:
+            if self.params.mask_loss_using_overlap < 0:
                 overlap = None
-            loss, loss_denoise, loss_spec = self.train_step(clean.to(self.device), conditioned_audio.to(self.device), conditoned_phonemes.to(self.device), conditioned_energy.to(self.device), overlap)
-            epoch_loss += loss.item()
+            #--- with gradient accumulation, only every `grad_accum_steps`-th micro-batch syncs grads and steps the optimizer
+            optimizer_step = (self.micro_step + 1) % self.grad_accum_steps == 0
+            loss, loss_denoise, loss_spec = self.train_step(clean, conditioned_audio, conditoned_phonemes, conditioned_energy, overlap, optimizer_step)
+            epoch_losses[0] += loss.detach()
             if loss_denoise is not None and loss_spec is not None:
-                epoch_loss_denoise += loss_denoise.item()
-                epoch_loss_spec += loss_spec.item()
-            if torch.isnan(loss).any():
+                epoch_losses[1] += loss_denoise.detach()
+                epoch_losses[2] += loss_spec.detach()
+            if self.micro_step % NAN_CHECK_EVERY_N_STEPS == 0 and torch.isnan(loss).any():
                 raise RuntimeError(f'Detected NaN loss at step {self.step}.')
-            self.step += 1
-        epoch_loss /= len(self.train_ds)
-        epoch_loss = distrib.average([epoch_loss])[0]
+            self.micro_step += 1
+            if optimizer_step:
+                self.step += 1
+        epoch_loss, epoch_loss_denoise, epoch_loss_spec = (epoch_losses / len(self.train_ds)).tolist()
+        if np.isnan(epoch_loss):
+            raise RuntimeError(f'Detected NaN loss in the epoch ending at step {self.step}.')
+        #--- one AllReduce for all three losses
+        epoch_loss, epoch_loss_denoise, epoch_loss_spec = distrib.average([epoch_loss, epoch_loss_denoise, epoch_loss_spec])
         
         if epoch_loss_denoise > 0 and epoch_loss_spec > 0:
-            epoch_loss_denoise /= len(self.train_ds)
-            epoch_loss_denoise = distrib.average([epoch_loss_denoise])[0]
-            
-            epoch_loss_spec /= len(self.train_ds)
-            epoch_loss_spec = distrib.average([epoch_loss_spec])[0]
             logger.info(f'train denoise loss: {epoch_loss_denoise:.4f} spec loss: {epoch_loss_spec:.4f}')
         
         return epoch_loss
@@ -152,39 +289,58 @@ class DiffARLearner:
     def eval_epoch(self, dataset):
         ### There is an option calculating pseq, stoi ###
         self.model.eval()
-        # all_pesq, all_stoi, n = 0, 0, 0
+        # metric_futures = []
         n = 0
-        epoch_loss_val = 0
-        for data in tqdm(dataset, desc=f'evaluating') if self.is_master else dataset:
-            clean, conditioned_audio, conditoned_phonemes, conditioned_energy, overlap  = data[0].squeeze(1), data[1].squeeze(1), data[2], data[3], data[4]
-
-            if self.params.mask_loss_using_overlap >= 0:
-                overlap = overlap.to(self.device)
-            else:
+        epoch_loss_val = torch.zeros((), device=self.device)
+        dataset = CUDAPrefetcher(dataset, self.device)
+        for clean, conditioned_audio, conditoned_phonemes, conditioned_energy, overlap in tqdm(dataset, desc=f'evaluating') if self.is_master else dataset:
+            if self.params.mask_loss_using_overlap < 0:
                 overlap = None
             # pred_audio = self.valid_step(noisy.to(self.device), clean.shape[1]).cpu(), text_grid_clean.to(self.device)
-            # pesq_sc, stoi_sc = run_metrics(clean, pred_audio, self.params.sample_rate)
-            # all_pesq += pesq_sc
-            # all_stoi += stoi_sc
-            # n += clean.shape[0]
+            # metric_futures.append(self.submit_metrics(clean.cpu(), pred_audio))
             # noisy1 = (noisy - clean)
             # noisy = noisy1 + self.augment(clean)
 
-            loss_val, loss_denoise_val, loss_spec_val = self.valid_loss(clean.to(self.device), conditioned_audio.to(self.device), conditoned_phonemes.to(self.device), conditioned_energy.to(self.device), overlap)
-            epoch_loss_val += loss_val.item()
-            if torch.isnan(torch.tensor(epoch_loss_val)).any():
-                 raise RuntimeError(f'Detected NaN loss at step {self.step}.')
+            loss_val, loss_denoise_val, loss_spec_val = self.valid_loss(clean, conditioned_audio, conditoned_phonemes, conditioned_energy, overlap)
+            epoch_loss_val += loss_val.detach()
             n += 1
         assert(n==len(self.valid_ds))
+        epoch_loss_val = epoch_loss_val.item()
+        if np.isnan(epoch_loss_val):
+            raise RuntimeError(f'Detected NaN loss at step {self.step}.')
         epoch_loss_val /= len(self.valid_ds)
         epoch_loss_val = distrib.average([epoch_loss_val])[0]
 
-        # all_pesq, all_stoi = all_pesq / n, all_stoi / n
+        # all_pesq, all_stoi = self.gather_metrics(metric_futures)
         # all_pesq, all_stoi = distrib.average([all_pesq, all_stoi])
         # return all_pesq, all_stoi, epoch_loss_val
 
         return epoch_loss_val
 
+    def submit_metrics(self, clean, pred_audio):
+        """
+        computes pesq/stoi of a batch in the background. clean, pred_audio - CPU tensors of shape [B, T]
+        """
+        return self._metric_pool.submit(run_metrics, clean, pred_audio, self.params.sample_rate), clean.shape[0]
+
+    def gather_metrics(self, metric_futures):
+        """
+        waits for the futures returned by `submit_metrics` and returns the mean pesq and stoi per sample
+        """
+        all_pesq, all_stoi, n = 0, 0, 0
+        for future, batch_size in metric_futures:
+            pesq_sc, stoi_sc = future.result()
+            all_pesq += pesq_sc
+            all_stoi += stoi_sc
+            n += batch_size
+        return all_pesq / n, all_stoi / n
+
+    def close(self):
+        self.wait_for_checkpoints()
+        self._save_executor.shutdown()
+        if self._metric_pool is not None:
+            self._metric_pool.shutdown()
+
     def test(self):
         if self.test_ds is None:
             logger.warning('test dataset is not set, skipping test')
@@ -232,6 +388,7 @@ class DiffARLearner:
             if max_steps is not None and self.step >= max_steps:
                 print("choose to finish")
                 print(self.step)
+                self.wait_for_checkpoints()
                 return
 
             epoch += 1
@@ -242,47 +399,72 @@ class DiffARLearner:
         loss = F.l1_loss(noise, predicted.squeeze(1), reduction = 'none')
         
         samples_before = self.params.mask_loss_using_overlap #--- samples before the overlap border to include in the loss
-        for row, k in enumerate(overlap):
-            k = max(0, k - samples_before)
-            loss[row, :k].zero_()
+        #--- zero the loss on the first `overlap - samples_before` samples of each row, in one masked multiply
+        k = (overlap - samples_before).clamp_min(0)
+        idx = torch.arange(loss.shape[1], device=loss.device)
+        mask = idx.unsqueeze(0) >= k.unsqueeze(1)
+        loss = loss * mask
         win_len = loss.shape[1] 
         non_overlap = win_len - overlap + samples_before
-        loss = loss / non_overlap.unsqueeze(1) / self.params.batch_size_train
-        loss = loss.sum()
+        loss = (loss.sum(dim=1) / non_overlap).sum() / self.params.batch_size_train
         return loss
 
-    def train_step(self, audio, audio_conditioner, phonemes_conditioner, Energy_conditioner, overlap = None):
-        # (itamark) setting grads to "None" instead of just calling optimizer.zero_grad(), makes sure params are not changed if grad is zero (as 
-        # would happen e.g when using weight decay, momentum, etc. 
-        # see e.g https://discuss.pytorch.org/t/in-optimizer-zero-grad-set-p-grad-none/31934/3
-        for param in self.model.parameters():
-            param.grad = None
+    def get_spec_loss(self, noise, predicted):
+        #--- the STFT stays in fp32 under autocast (cuFFT half precision is limited to power-of-2 sizes)
+        with torch.autocast(device_type=noise.device.type, enabled=False):
+            #--- a single STFT over both signals, stacked along the batch
+            mel = self.log_mel_spec(torch.cat([noise, predicted.squeeze(1)], dim=0).float())
+            mel_noise, mel_predicted = mel.chunk(2, dim=0)
+            return F.l1_loss(mel_noise, mel_predicted)
+
+    def sample_noise(self, audio):
         N, T = audio.shape
-        device = audio.device
-        self.noise_level = self.noise_level.to(device)
-        t = torch.randint(0, len(self.params.noise_schedule), [N], device=audio.device)
-        noise_scale = self.noise_level[t].unsqueeze(1)
-        noise_scale_sqrt = noise_scale**0.5
-        noise = torch.randn_like(audio)
-        noisy_audio = noise_scale_sqrt * audio + (1.0 - noise_scale)**0.5 * noise
-        predicted = self.model(noisy_audio, audio_conditioner.unsqueeze(1), t, phonemes_conditioner, Energy_conditioner)
+        if self._noise_buffer is None or self._noise_buffer.shape[0] < N or self._noise_buffer.shape[1] != T:
+            self._noise_buffer = torch.empty(max(N, self.params.batch_size_train), T, device=audio.device, dtype=audio.dtype)
+        return self._noise_buffer[:N].normal_(generator=self._noise_generator)
+
+    def _loss_denoise_only(self, noise, predicted, overlap):
         if overlap is None:
             loss_denoise = F.l1_loss(noise, predicted.squeeze(1))
         else:
             loss_denoise = self.get_loss_with_overlap_mask(noise, predicted, overlap)
-        
-        if self.params.spec_loss_coeff > 0.:
-            loss_spec = F.l1_loss(self.log_mel_spec(noise), self.log_mel_spec(predicted.squeeze(1)))
-            #logger.info(f'denoise loss: {loss_denoise:.4f} spec loss: {loss_spec:.4f}')
-            loss_coeff = self.params.spec_loss_coeff
-            loss = (1 - loss_coeff) * loss_denoise + loss_coeff * loss_spec
-        else:
-            loss_spec = None
-            loss = loss_denoise
+        return loss_denoise, loss_denoise, None
+
+    def _loss_with_spec(self, noise, predicted, overlap):
+        _, loss_denoise, _ = self._loss_denoise_only(noise, predicted, overlap)
+        loss_spec = self.get_spec_loss(noise, predicted)
+        #logger.info(f'denoise loss: {loss_denoise:.4f} spec loss: {loss_spec:.4f}')
+        loss_coeff = self.params.spec_loss_coeff
+        loss = (1 - loss_coeff) * loss_denoise + loss_coeff * loss_spec
+        return loss, loss_denoise, loss_spec
 
-        loss.backward()
-        self.grad_norm = nn.utils.clip_grad_norm_(self.model.parameters(), self.params.max_grad_norm or 1e9)
-        self.optimizer.step()
+    def train_step(self, audio, audio_conditioner, phonemes_conditioner, Energy_conditioner, overlap = None, optimizer_step = True):
+        N, T = audio.shape
+        device = audio.device
+        #--- skip the DDP AllReduce on micro-batches that only accumulate grads
+        sync_context = self.model.no_sync if (self.is_distributed and not optimizer_step) else contextlib.nullcontext
+        with sync_context():
+            with torch.autocast(device_type=device.type, dtype=self.amp_dtype, enabled=self.use_amp):
+                t = torch.randint(0, self.num_steps, [N], device=audio.device)
+                noise = self.sample_noise(audio)
+                noisy_audio = make_noisy_audio(audio, noise, t, self.noise_level_sqrt, self.one_minus_noise_level_sqrt)
+                predicted = self.model(noisy_audio, audio_conditioner.unsqueeze(1), t, phonemes_conditioner, Energy_conditioner)
+                loss, loss_denoise, loss_spec = self.compute_loss(noise, predicted, overlap)
+
+            self.scaler.scale(loss / self.grad_accum_steps).backward()
+
+        if optimizer_step:
+            self.scaler.unscale_(self.optimizer)
+            self.grad_norm = nn.utils.clip_grad_norm_(self.model.parameters(), self.params.max_grad_norm or 1e9)
+            self.scaler.step(self.optimizer)
+            self.scaler.update()
+            # (itamark) setting grads to "None" instead of zeroing them, makes sure params are not changed if grad is zero (as 
+            # would happen e.g when using weight decay, momentum, etc. 
+            # see e.g https://discuss.pytorch.org/t/in-optimizer-zero-grad-set-p-grad-none/31934/3
+            #--- under DDP the grads are views into the reducer buckets (gradient_as_bucket_view): zero them in place so they
+            #    stay views, otherwise the next backward allocates fresh grads and the reducer copies them into the buckets.
+            #    with static_graph every param gets a grad on every step, so this is equivalent for Adam
+            self.optimizer.zero_grad(set_to_none=not self.is_distributed)
         
         return loss, loss_denoise, loss_spec
 
@@ -340,30 +522,13 @@ class DiffARLearner:
 
     def valid_loss(self, audio, audio_conditioner, phonemes_conditioner, Energy_conditioner, overlap = None):
         device = audio.device
-        with torch.no_grad():
+        with torch.no_grad(), torch.autocast(device_type=device.type, dtype=self.amp_dtype, enabled=self.use_amp):
             N, T = audio.shape
-            device = audio.device
-            self.noise_level = self.noise_level.to(device)
-            t = torch.randint(0, len(self.params.noise_schedule), [N], device=audio.device)
-            noise_scale = self.noise_level[t].unsqueeze(1)
-            noise_scale_sqrt = noise_scale ** 0.5
-            noise = torch.randn_like(audio)
-            noisy_audio = noise_scale_sqrt * audio + (1.0 - noise_scale) ** 0.5 * noise
+            t = torch.randint(0, self.num_steps, [N], device=audio.device)
+            noise = self.sample_noise(audio)
+            noisy_audio = make_noisy_audio(audio, noise, t, self.noise_level_sqrt, self.one_minus_noise_level_sqrt)
             predicted = self.model(noisy_audio, audio_conditioner.unsqueeze(1), t, phonemes_conditioner, Energy_conditioner)
-            if overlap is None:
-                loss_denoise = F.l1_loss(noise, predicted.squeeze(1))
-            else:
-                loss_denoise = self.get_loss_with_overlap_mask(noise, predicted, overlap)
-            
-            if self.params.spec_loss_coeff > 0.:
-                loss_spec = F.l1_loss(self.log_mel_spec(noise), self.log_mel_spec(predicted.squeeze(1)))
-                #logger.info(f'denoise loss: {loss_denoise:.4f} spec loss: {loss_spec:.4f}')
-                loss_coeff = self.params.spec_loss_coeff
-                loss = (1 - loss_coeff) * loss_denoise + loss_coeff * loss_spec
-            else:
-                loss_spec = None
-                loss = loss_denoise
-            
+            loss, loss_denoise, loss_spec = self.compute_loss(noise, predicted, overlap)
             return loss, loss_denoise, loss_spec
 
 ### TODO: if pseq / stoi  are relevant ###
@@ -396,8 +561,12 @@ class DiffARLearner:
 
 def mytrain(replica_id, replica_count, port, params):
     torch.backends.cudnn.benchmark = True
+    #--- spawned replicas don't inherit the seed set in __main__; seeding per rank also gives the DataLoader workers
+    #    of every rank their own base seed (segment sampling). DDP broadcasts rank 0's weights, so init is unaffected
+    torch.manual_seed(params.seed + replica_id)
     is_distributed = replica_count > 1
-    params.noise_schedule = np.linspace(**params.noise_schedule,).tolist() # TODO ???????
+    #--- kept as a list: the model and inference read it from params, which is saved with every checkpoint
+    params.noise_schedule = np.linspace(**params.noise_schedule,).tolist()
     global logger
     logger.info = logger.info if replica_id == 0 else lambda x: x
 
@@ -408,7 +577,16 @@ def mytrain(replica_id, replica_count, port, params):
         device = torch.device('cuda', replica_id)
         torch.cuda.set_device(device)
         model = DiffAR(params).to(device)
-        model = DistributedDataParallel(model, device_ids=[replica_id])
+        #--- the DiffAR graph is identical on every step and has no BN-style buffers, so let DDP pre-plan its buckets
+        #    and have param.grad alias the bucket memory (saves a grad->bucket copy every step, as long as the grads are
+        #    zeroed in place rather than set to None, see train_step)
+        model = DistributedDataParallel(model, device_ids=[replica_id], gradient_as_bucket_view=True, bucket_cap_mb=50,
+                                        static_graph=True, broadcast_buffers=False)
+        #--- AllReduce the grads in half precision (params and optimizer state stay fp32)
+        if params.ddp_comm_compression == 'bf16':
+            model.register_comm_hook(state=None, hook=ddp_hooks.bf16_compress_hook)
+        elif params.ddp_comm_compression == 'fp16':
+            model.register_comm_hook(state=None, hook=ddp_hooks.fp16_compress_hook)
     else:
         model = DiffAR(params).cuda()
     if params.replica_id_attempt==3:
@@ -416,6 +594,9 @@ def mytrain(replica_id, replica_count, port, params):
         device = torch.device('cuda', params.replica_id_attempt)
         torch.cuda.set_device(device)
         model = DiffAR(params).to(device)
+    if params.compile_model:
+        #--- only the DiffAR forward is compiled; the log-mel spec loss (torchaudio) stays in eager mode
+        model = torch.compile(model, mode='max-autotune', fullgraph=False, dynamic=False)
 
     train_ds = instantiate(params.train_ds)
     train_ds = torch.utils.data.DataLoader(
@@ -424,8 +605,11 @@ def mytrain(replica_id, replica_count, port, params):
         shuffle=not is_distributed,
         num_workers=params.num_workers,
         sampler=DistributedSampler(train_ds) if is_distributed else None,
+        collate_fn=collate_batch,
         pin_memory=True,
         drop_last=True,
+        persistent_workers=params.num_workers > 0,
+        prefetch_factor=4 if params.num_workers > 0 else None,
     )
 
     if 'valid_ds' in params:
@@ -436,8 +620,11 @@ def mytrain(replica_id, replica_count, port, params):
             shuffle=not is_distributed,
             num_workers=params.num_workers,
             sampler=DistributedSampler(valid_ds) if is_distributed else None,
+            collate_fn=collate_batch,
             pin_memory=True,
             drop_last=True,
+            persistent_workers=params.num_workers > 0,
+            prefetch_factor=4 if params.num_workers > 0 else None,
         )
     else:
         valid_ds = None
@@ -450,8 +637,11 @@ def mytrain(replica_id, replica_count, port, params):
             shuffle=not is_distributed,
             num_workers=params.num_workers,
             sampler=DistributedSampler(test_ds) if is_distributed else None,
+            collate_fn=collate_batch,
             pin_memory=True,
             drop_last=True,
+            persistent_workers=params.num_workers > 0,
+            prefetch_factor=4 if params.num_workers > 0 else None,
         )
     else:
         test_ds = None
@@ -465,3 +655,5 @@ def mytrain(replica_id, replica_count, port, params):
     except:
         print("stratin exept")
         torch.distributed.destroy_process_group()
+    finally:
+        learner.close()
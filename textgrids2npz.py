@@ -0,0 +1,6 @@
+import sys
+from audio import preprocess_textgrids
+
+if __name__ == "__main__":
+    # usage: python textgrids2npz.py <textgrid manifest json> <out npz>
+    preprocess_textgrids(sys.argv[1], sys.argv[2])
@@ -1,4 +1,3 @@
-import random
 import os
 import sys
 import json
@@ -7,7 +6,6 @@ import logging
 import textgrid
 import torch
 import torchaudio
-import math
 import numpy as np
 #torchaudio.set_audio_backend("sox_io")
 import csv
@@ -89,11 +87,11 @@ def get_overlap_duration(start_p, info_taken_phonemes, window_length):
     assert total_phonemes>=1, "There must be at list one phoneme in a current window"
     desirable_phonemes = np.abs((-total_phonemes)//3)
     assert desirable_phonemes>=1, "There must be at list one phoneme in the overlap area"
-    overlap_duration = info_taken_phonemes[desirable_phonemes-1].maxTime*16000 - start_p
-    i=2
-    while overlap_duration > window_length/2 and desirable_phonemes-i>=0:
-        overlap_duration = info_taken_phonemes[desirable_phonemes-i].maxTime*16000 - start_p
-        i+=1
+    overlap_ends = np.array([phoneme.maxTime for phoneme in info_taken_phonemes[:desirable_phonemes]])*16000 - start_p
+    ## the ends are sorted, so the last one of the desirable phonemes that ends in the first half of the window
+    ## (or the first phoneme, if none does) is found with a single search
+    last_fitting = max(np.searchsorted(overlap_ends, window_length/2, side='right') - 1, 0)
+    overlap_duration = overlap_ends[last_fitting]
     overlap_duration =  min(int(round(overlap_duration)),  int(round(window_length/2)))
     return overlap_duration
 
@@ -108,7 +106,8 @@ def sample_segment(audio, n_samples, ret_idx=False):
     """
     if audio.shape[1] > n_samples:
         diff = audio.shape[1] - n_samples
-        start = random.randint(0, diff)
+        # torch RNG is seeded per DataLoader worker, so workers draw different segments
+        start = int(torch.randint(0, diff + 1, (1,)))
         end = start + n_samples
         new_audio = audio[:, start:end]
         if ret_idx:
@@ -119,75 +118,41 @@ def sample_segment(audio, n_samples, ret_idx=False):
         return audio, (0, audio.shape[1] - 1)
     return audio
 
-def build_phoneme_and_energy_representation(total_phoneme_len, phoneme_numer, cur_energy):
+def phoneme_tier_bounds(phonemes_a, sr):
+    """
+    start and end samples of every phoneme of a tier, computed once per file
+    and passed to every `Build_excisting_phonemes_sec_approach` call on it
+    """
+    all_start_phonemes = np.rint(np.array([phoneme.minTime for phoneme in phonemes_a], dtype=np.float64) * sr)
+    all_end_phonemes = np.rint(np.array([phoneme.maxTime for phoneme in phonemes_a], dtype=np.float64) * sr)
+    return all_start_phonemes, all_end_phonemes
+
+def Build_excisting_phonemes_sec_approach(start_frame, end_frame ,phonemes_a, Energy_a, sr, tier_bounds=None):
+    """
+    tier_bounds - `phoneme_tier_bounds(phonemes_a, sr)`, computed here if not given
+    """
+    _lookup = phoneme_to_index_dict.__getitem__
+    if tier_bounds is None:
+        tier_bounds = phoneme_tier_bounds(phonemes_a, sr)
+    n_phonemes = min(len(phonemes_a), len(Energy_a))
+    all_start_phonemes, all_end_phonemes = tier_bounds[0][:n_phonemes], tier_bounds[1][:n_phonemes]
+    ## phonemes are sorted in time, so binary search the ones overlapping the window
+    lo = np.searchsorted(all_end_phonemes, start_frame, side='right')
+    hi = max(np.searchsorted(all_start_phonemes, end_frame, side='left'), lo)
+    taken_phonemes = list(phonemes_a[lo:hi])
+    start_phonemes = all_start_phonemes[lo:hi]
+    end_phonemes = all_end_phonemes[lo:hi]
+    ## the part of every phoneme that is inside the window
+    phoneme_lengths = np.rint(np.minimum(end_phonemes, end_frame) - np.maximum(start_phonemes, start_frame)).astype(np.int64)
+    phonemes_idx = np.fromiter((_lookup(phoneme.mark) for phoneme in taken_phonemes), dtype=np.int64, count=len(taken_phonemes))
+
+    ## represent by repeating the phoneme_number devided by the total num of the phonemes, both signals are built in one pass
+    conditioned_phonemes_signal = torch.from_numpy(np.repeat(phonemes_idx / TOTAL_AVAILABLE_PHONEMES, phoneme_lengths).astype(np.float32))
+    conditioned_energy_signal = torch.from_numpy(np.repeat(np.asarray(Energy_a[lo:hi], dtype=np.float32), phoneme_lengths))
 
-    represent_sign = phoneme_numer / TOTAL_AVAILABLE_PHONEMES
-    phonemes_representaion = torch.Tensor.repeat(torch.tensor(represent_sign),math.floor(total_phoneme_len))
-    energy_representaion = torch.Tensor.repeat(torch.tensor(cur_energy),math.floor(total_phoneme_len))
-    
-    return phonemes_representaion, energy_representaion
-
-def Build_excisting_phonemes_sec_approach(start_frame, end_frame ,phonemes_a, Energy_a, sr):
-    list_taken_phonemes = []
-    list_info_taken_phonemes = []
-    conditioned_phonemes_signal = torch.empty((0)) 
-    conditioned_energy_signal = torch.empty((0)) 
-
-    for phoneme, cur_energy in zip(phonemes_a,Energy_a) :
-        start_phoneme = round(phoneme.minTime * sr)
-        end_phoneme = round(phoneme.maxTime * sr)
-        phoneme_mark = phoneme.mark
-        if start_phoneme >= end_frame : # --> start_frame < start_phoneme
-            break
-        elif end_phoneme <= start_frame : # --> end_frame>end_phoneme
-            continue
-        elif start_phoneme >= start_frame:
-            if end_phoneme<= end_frame:
-                total_phoneme_length = round(end_phoneme-start_phoneme)
-                list_taken_phonemes.append([phoneme_to_index_dict[phoneme_mark],total_phoneme_length])
-                list_info_taken_phonemes.append(phoneme)
-                cur_phoneme_representaion, cur_energy_representation = build_phoneme_and_energy_representation(total_phoneme_length,
-                                                phoneme_to_index_dict[phoneme_mark], cur_energy)
-                conditioned_phonemes_signal = torch.concat((conditioned_phonemes_signal,cur_phoneme_representaion))
-                conditioned_energy_signal = torch.concat((conditioned_energy_signal,cur_energy_representation))
-                continue
-            else: # --> end_phoneme > end_frame
-                total_phoneme_length = round(end_frame-start_phoneme)
-                list_taken_phonemes.append([phoneme_to_index_dict[phoneme_mark],total_phoneme_length])
-                list_info_taken_phonemes.append(phoneme)
-                cur_phoneme_representaion, cur_energy_representation = build_phoneme_and_energy_representation(total_phoneme_length,
-                                                phoneme_to_index_dict[phoneme_mark], cur_energy)
-                conditioned_phonemes_signal = torch.concat((conditioned_phonemes_signal,cur_phoneme_representaion))
-                conditioned_energy_signal = torch.concat((conditioned_energy_signal,cur_energy_representation))
-                continue
-        elif start_phoneme <= start_frame:
-            if end_phoneme >= end_frame:
-                total_phoneme_length = round(end_frame-start_frame)
-                list_taken_phonemes.append([phoneme_to_index_dict[phoneme_mark],total_phoneme_length])
-                list_info_taken_phonemes.append(phoneme)
-                cur_phoneme_representaion, cur_energy_representation = build_phoneme_and_energy_representation(total_phoneme_length,
-                                                phoneme_to_index_dict[phoneme_mark], cur_energy)
-                conditioned_phonemes_signal = torch.concat((conditioned_phonemes_signal,cur_phoneme_representaion))
-                conditioned_energy_signal = torch.concat((conditioned_energy_signal,cur_energy_representation))
-                continue
-            else: # --> end_frame > end_phonem
-                total_phoneme_length = round(end_phoneme-start_frame)
-                list_taken_phonemes.append([phoneme_to_index_dict[phoneme_mark],total_phoneme_length])
-                list_info_taken_phonemes.append(phoneme)
-                cur_phoneme_representaion, cur_energy_representation = build_phoneme_and_energy_representation(total_phoneme_length,
-                                                phoneme_to_index_dict[phoneme_mark], cur_energy)
-                conditioned_phonemes_signal = torch.concat((conditioned_phonemes_signal,cur_phoneme_representaion))
-                conditioned_energy_signal = torch.concat((conditioned_energy_signal,cur_energy_representation))
-                continue
-        else:
-            assert  False, "There is at least one missed case "
-
-    tensor_taken_phonemes = torch.tensor(list_taken_phonemes)
-    
     assert conditioned_phonemes_signal.shape[0] == int(round(end_frame-start_frame)), f"some how {conditioned_phonemes_signal.shape[0]} and {end_frame-start_frame} are different"
-    assert conditioned_phonemes_signal.shape[0] == conditioned_energy_signal.shape[0], f"some how {conditioned_phonemes_signal.shape[0]} and {conditioned_energy_signal.shape[0]} are different"
-    assert tensor_taken_phonemes.shape[0]>0 , "There are no phonemes in the phonemes tensor."
-    return conditioned_phonemes_signal[None,:], list_info_taken_phonemes, conditioned_energy_signal[None,:]
+    assert len(taken_phonemes)>0 , "There are no phonemes in the phonemes tensor."
+    return conditioned_phonemes_signal[None,:], taken_phonemes, conditioned_energy_signal[None,:]
 
 class TextGridDataset(torch.utils.data.Dataset):
     def __init__(self, json_manifest_TextGrids):
@@ -300,17 +265,26 @@ class PairedAudioDataset(torch.utils.data.Dataset):
         # return audio_a, audio_b, tensor_excisting_phonemes
 
     def build_embedding_table(self, max_steps):
-        steps = torch.arange(max_steps).unsqueeze(1)    # [T,1]
-        dims = torch.arange(64).unsqueeze(0)                    # [1,64]
-        table = steps * 10.0**(dims * 4.0 / 63.0)         # [T,64]
-        table = torch.cat([torch.sin(table), torch.cos(table)], dim=1)
+        freqs = torch.pow(10.0, torch.arange(64, dtype=torch.float32) * (4.0 / 63.0))  # [64]
+        steps = torch.arange(max_steps, dtype=torch.float32).unsqueeze(1)            # [T,1]
+        angles = steps * freqs                                                       # [T,64]
+        table = torch.empty(max_steps, 128)
+        torch.sin(angles, out=table[:, :64])
+        torch.cos(angles, out=table[:, 64:])
         return table
 
+@torch.jit.script
+def clamp_log(x: torch.Tensor) -> torch.Tensor:
+    # scripted so clamp and log are fused into one element-wise kernel
+    return torch.log(torch.clamp(x, min=1e-5))
+
 class LogMelSpectrogram(torchaudio.transforms.MelSpectrogram):
     def forward(self, x):
         x = super().forward(x)
-        x = torch.log(torch.clamp(x, min=1e-5))
-        return x
+        if x.requires_grad:
+            return clamp_log(x)
+        # the mel is freshly allocated, so it can be overwritten when no gradient flows through it
+        return x.clamp_(min=1e-5).log_()
 
 if __name__ == "__main__":
     print("utils_for_inference")